@@ -12,52 +12,48 @@ Assumptions:
     - CIGAR with only deletions are invalid
 
 Strengths:
-    - For each query in input2, runtime is O(n) where
-      n is the length of the transcript (not the cigar), and space efficiency
-      is also linear on transcript length
+    - For each query in input2, runtime is O(log n) where n is the number of
+      operations in the CIGAR (not the transcript length); the CIGAR is
+      never expanded, so space is linear on the number of CIGAR operations
+    - CIGARs are parsed and indexed once per transcript when input1 is read,
+      so repeated queries against a transcript don't re-parse it
     - Checks user input for correct number of columns, validates CIGAR string
+    - All of input2 is read up front and queries are grouped by transcript,
+      so each transcript's index is looked up once per batch of queries
+    - Queries can be resolved in parallel across processes (--workers)
+    - The parsed transcripts can be saved and reused across runs
+      (--index-file), skipping CIGAR parsing on warm starts
 
 Weaknesses:
-    - Processes each query in sequence; could be done in parallel
-      after reading in all of input2 and storing it in a dict
-    - Could be O(n) where n is the length of the cigar, if using the following
-      in get_genome_pos:
-        ```
-        transcript_idx = -1
-        genome_pos = start_pos -1
-        for idx in range(0, len(cigar_str)):
-            if transcript_idx >= transcript_coord:
-                genome_pos = genome_pos + transcript_coord - transcript_idx
-                break
-            char = cigar_str[idx]
-            if char.isnumeric():
-                num_bases += char
-            elif char == 'M':
-                transcript_idx += int(num_bases)
-                genome_pos += int(num_bases)
-                num_bases = str()
-            elif char == 'D':
-                genome_pos += int(num_bases)
-                num_bases = str()
-            elif char == 'I':
-                # insertion
-                transcript_idx += int(num_bases)
-                num_bases = str()
-        ```
-      But this doesn't handle the case where the query position is in an
-      insertion in the transcript. So depending on the desired behavior of
-      handling that case, could be more efficient.  This solution would also
-      be more space efficient since the expanded cigar string would not have to
-      be stored.  However I think that the presented solution in get_genome_pos
-      is more intuitive/readable, with the same time complexity.
+    - Holds all of input2 and its results in memory before writing out
 
 Testing:
     - InvitaeTechTest.py for unittests.
 '''
 
 from argparse import ArgumentParser
-import csv
-import re
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice, repeat
+import mmap
+from operator import le
+import os
+import pickle
+import stat
+import tempfile
+
+# Read/write buffer size for the query and output files
+IO_BUFFER_SIZE = 1 << 20
+# Number of output rows to accumulate before writing them out
+OUT_BATCH_ROWS = 8192
+# Number of queries per chunk when resolving queries in parallel
+QUERY_CHUNK_SIZE = 10_000
+# Lookup tables indexed by CIGAR byte: its value as a count digit (-1 if
+# it isn't a digit), and whether it's a supported op (M, I or D)
+CIGAR_DIGITS = tuple(
+    byte - 48 if 48 <= byte <= 57 else -1 for byte in range(256))
+CIGAR_OPS = tuple(byte in b'MID' for byte in range(256))
 
 
 def get_transcript_dict(transcript_file):
@@ -70,29 +66,227 @@ def get_transcript_dict(transcript_file):
             cigar string.
     Returns:
         A dict of dicts of transcripts, their chromosome location,
-        start position and cigar string.
+        start position, cigar string and cigar index (see index_cigar).
+        IDs, chromosomes and cigar strings are kept as bytes.
     Raises:
-        ValueError: if there are duplicate transcript ID's.
+        ValueError: if there are duplicate transcript ID's, or a cigar string
+            is invalid.
+    '''
+
+    with open(transcript_file, 'rb') as tr_f:
+        tr_stat = os.fstat(tr_f.fileno())
+        if not stat.S_ISREG(tr_stat.st_mode):
+            # pipes, FIFOs and process substitution can't be mapped, so read
+            # them line by line
+            return _build_transcript_dict(lines=tr_f)
+        if tr_stat.st_size == 0:
+            # mmap can't map an empty file
+            return dict()
+        # Map the whole file and read lines out of memory rather than through
+        # buffered per-line file reads
+        with mmap.mmap(tr_f.fileno(), 0, access=mmap.ACCESS_READ) as tr_mm:
+            return _build_transcript_dict(lines=iter(tr_mm.readline, b''))
+
+
+def _build_transcript_dict(lines):
+    '''
+    Builds the transcript dict from the lines of a transcript file; see
+    get_transcript_dict.
+
+    Args:
+        lines: iterable of the transcript file's lines, as bytes
+    Returns:
+        A dict of dicts of transcripts, as from get_transcript_dict.
+    Raises:
+        ValueError: if there are duplicate transcript ID's, or a cigar string
+            is invalid.
     '''
 
     transcripts = dict()
-    with open(transcript_file, 'r') as tr_f:
-        for line in tr_f:
-            fields = [i.strip() for i in line.split('\t')]
-            if len(fields) != 4:
-                raise ValueError(f'Incorrect format; only {len(fields)} cols.')
-            tr_id, chrom, pos, cigar = fields
-            if not is_cigar_valid(cigar):
-                raise ValueError(f'Invalid cigar {cigar}.')
-            if tr_id not in transcripts:
-                transcripts[tr_id] = {
-                    'gen_chrom': chrom,
-                    'gen_start': int(pos),
-                    'cigar': cigar
-                }
-            else:
-                # Assume having duplicate id's is user error
-                raise ValueError(f'Transcript {tr_id} is not unique.')
+    for line in lines:
+        fields = line.rstrip(b'\r\n').split(b'\t')
+        if len(fields) != 4:
+            raise ValueError(f'Incorrect format; only {len(fields)} cols.')
+        tr_id, chrom, pos, cigar = fields
+        if tr_id not in transcripts:
+            transcripts[tr_id] = {
+                'gen_chrom': chrom,
+                'gen_start': int(pos),
+                'cigar': cigar,
+                **index_cigar(cigar)
+            }
+        else:
+            # Assume having duplicate id's is user error
+            raise ValueError(f'Transcript {tr_id!r} is not unique.')
+    return transcripts
+
+
+def get_file_identity(path):
+    '''
+    Identifies the file at path by its resolved path, size and modification
+    time, so an index can tell whether it was built from that file as it is
+    now.
+
+    Args:
+        path: path to the file
+    Returns:
+        A tuple of the file's real path, size and mtime in nanoseconds.
+    Raises:
+        OSError: if path can't be stat'd
+    '''
+    file_stat = os.stat(path)
+    return os.path.realpath(path), file_stat.st_size, file_stat.st_mtime_ns
+
+
+def save_transcript_index(transcripts, index_file, source=None):
+    '''
+    Saves the transcript dict to index_file in a compact columnar layout:
+    a list per transcript field, and every transcript's cigar runs
+    concatenated into one array per field with offsets marking where each
+    transcript's runs start. This pickles a handful of large objects rather
+    than several small arrays per transcript.
+
+    Args:
+        transcripts: transcript dict (from get_transcript_dict)
+        index_file: path to write the index to
+        source: optional identity of the transcript file the dict was built
+            from (see get_file_identity), recorded in the index
+    Returns:
+        None; writes index_file.
+    Raises:
+        None
+    '''
+
+    index = {
+        'source': source,
+        'tr_ids': list(transcripts),
+        'gen_chrom': list(),
+        'gen_start': array('q'),
+        'cigar': list(),
+        'transcript_len': array('q'),
+        'counts': array('q'),
+        'ops': bytearray(),
+        'tr_ends': array('q'),
+        'gen_shifts': array('q'),
+        'offsets': array('q', [0])
+    }
+    for transcript in transcripts.values():
+        index['gen_chrom'].append(transcript['gen_chrom'])
+        index['gen_start'].append(transcript['gen_start'])
+        index['cigar'].append(transcript['cigar'])
+        index['transcript_len'].append(transcript['transcript_len'])
+        index['counts'] += transcript['counts']
+        index['ops'] += transcript['ops']
+        index['tr_ends'] += transcript['tr_ends']
+        index['gen_shifts'] += transcript['gen_shifts']
+        index['offsets'].append(len(index['ops']))
+    # slices of bytes are bytes, matching index_cigar
+    index['ops'] = bytes(index['ops'])
+
+    # Write to a temporary file of its own first, so a partly written index
+    # is never picked up by another run, even one saving to the same path
+    tmp_fd, tmp_index_file = tempfile.mkstemp(
+        dir=os.path.dirname(index_file) or '.',
+        prefix=f'{os.path.basename(index_file)}.',
+        suffix='.tmp')
+    try:
+        with os.fdopen(tmp_fd, 'wb') as index_f:
+            pickle.dump(index, index_f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_index_file, index_file)
+    except BaseException:
+        os.remove(tmp_index_file)
+        raise
+    return
+
+
+def read_transcript_index(index_file, source=None):
+    '''
+    Rebuilds the transcript dict from an index_file written by
+    save_transcript_index.
+
+    Args:
+        index_file: path to the index. Only read index files this script
+            wrote, as they are loaded with pickle.
+        source: optional identity of the transcript file the index is
+            expected to have been built from (see get_file_identity)
+    Returns:
+        A dict of dicts of transcripts, as from get_transcript_dict, or None
+        if source is given and the index was built from a different file.
+    Raises:
+        None
+    '''
+
+    with open(index_file, 'rb') as index_f:
+        index = pickle.load(index_f)
+    if source is not None and index.get('source') != source:
+        return None
+
+    gen_chroms, gen_starts = index['gen_chrom'], index['gen_start']
+    cigars, transcript_lens = index['cigar'], index['transcript_len']
+    counts, ops = index['counts'], index['ops']
+    tr_ends, gen_shifts = index['tr_ends'], index['gen_shifts']
+    offsets = index['offsets']
+
+    transcripts = dict()
+    for idx, tr_id in enumerate(index['tr_ids']):
+        # each transcript's runs are sliced back out of the shared arrays
+        runs = slice(offsets[idx], offsets[idx + 1])
+        transcripts[tr_id] = {
+            'gen_chrom': gen_chroms[idx],
+            'gen_start': gen_starts[idx],
+            'cigar': cigars[idx],
+            'counts': counts[runs],
+            'ops': ops[runs],
+            'tr_ends': tr_ends[runs],
+            'gen_shifts': gen_shifts[runs],
+            'transcript_len': transcript_lens[idx]
+        }
+    return transcripts
+
+
+def load_transcript_dict(transcript_file, index_file=None):
+    '''
+    Builds the transcript dict (see get_transcript_dict), reusing a copy
+    saved to index_file when it was built from transcript_file as it is now,
+    so repeated runs against the same transcripts skip parsing and indexing
+    the CIGARs.
+
+    Args:
+        transcript_file: path to the tsv of file transcripts.
+        index_file: optional path to save the transcript dict to and load it
+            from (see save_transcript_index). It is rebuilt from
+            transcript_file whenever it is missing, isn't a readable index,
+            or was built from a file with a different path, size or mtime.
+            Ignored when transcript_file isn't a regular file (eg a pipe).
+            It is loaded with pickle, so only point it at a trusted path.
+    Returns:
+        A dict of dicts of transcripts, as from get_transcript_dict.
+    Raises:
+        ValueError: if there are duplicate transcript ID's, or a cigar string
+            is invalid.
+    '''
+
+    if index_file is None or not os.path.isfile(transcript_file):
+        return get_transcript_dict(transcript_file=transcript_file)
+
+    # Identify the transcript file before reading it, so changes made while
+    # it's read make the saved index stale rather than wrongly current
+    source = get_file_identity(transcript_file)
+    if os.path.exists(index_file):
+        try:
+            transcripts = read_transcript_index(
+                index_file=index_file, source=source)
+        except (pickle.UnpicklingError, EOFError, AttributeError, IndexError,
+                KeyError, TypeError, ValueError):
+            # Not a (complete) index this script wrote; rebuild it like a
+            # stale one
+            transcripts = None
+        if transcripts is not None:
+            return transcripts
+
+    transcripts = get_transcript_dict(transcript_file=transcript_file)
+    save_transcript_index(
+        transcripts=transcripts, index_file=index_file, source=source)
     return transcripts
 
 
@@ -107,39 +301,79 @@ def is_cigar_valid(cigar_str):
         None
     '''
 
-    return bool(re.match(r'^([0-9]+[M|I|D])+$', cigar_str))
+    try:
+        index_cigar(cigar_str)
+    except ValueError:
+        return False
+    return True
 
 
-def cigar_str_to_list(cigar_str):
+def index_cigar(cigar_str):
     '''
-    Expands the CIGAR string to a list where each character
-    is either M|D|I matching the position described in cigar_str.
-    Eg 3M1D2I -> [M, M, M, D, I, I]
+    Validates and parses the CIGAR string and precomputes the transcript
+    offset at the end of every run and its shift onto the genome, all in one
+    pass over the CIGAR, so a transcript coordinate can be located by
+    bisection rather than by walking the CIGAR.
+    Eg 3M1D2I -> tr_ends [3, 3, 5], gen_shifts [0, 1, -1]
 
     Args:
-        cigar_str: cigar string
+        cigar_str: cigar string, as bytes or str
     Returns:
-        A list of characters for every position in the CIGAR
-
+        A dict of the run counts, ops, the cumulative transcript length at
+        the end of every run (tr_ends), the shift from a transcript
+        coordinate to its genome offset in every match run (gen_shifts), and
+        the length of the transcript (transcript_len)
     Raises:
-        None
+        ValueError: if cigar_str is not one or more runs of digits each
+            followed by M, I or D
     '''
-    cigar_list = list()
-    num_str = str()
-    for char in cigar_str:
-        if char.isnumeric():
-            # append characters that are numbers for multiple digits
-            num_str += char
+    if isinstance(cigar_str, str):
+        cigar_str = cigar_str.encode()
+    counts = array('q')
+    ops = bytearray()
+    tr_ends = array('q')
+    gen_shifts = array('q')
+    tr_len = 0
+    gen_len = 0
+    count = 0
+    deletion = ord('D')
+    insertion = ord('I')
+    # False while expecting the first digit of a run, True once in its digits
+    in_digits = False
+    for byte in cigar_str:
+        digit = CIGAR_DIGITS[byte]
+        if digit >= 0:
+            # accumulate multiple digit counts
+            count = count * 10 + digit
+            in_digits = True
+        elif in_digits and CIGAR_OPS[byte]:
+            # end of a run, extend the transcript and/or genome by it
+            if byte != deletion:
+                tr_len += count
+            if byte != insertion:
+                gen_len += count
+            counts.append(count)
+            ops.append(byte)
+            tr_ends.append(tr_len)
+            gen_shifts.append(gen_len - tr_len)
+            count = 0
+            in_digits = False
         else:
-            # char.isalpha():
-            cigar_list.extend(int(num_str) * [char])
-            # reset num_str
-            num_str = str()
+            raise ValueError(f'Invalid cigar {cigar_str!r}.')
+    if in_digits or not ops:
+        # trailing count without an op, or empty cigar
+        raise ValueError(f'Invalid cigar {cigar_str!r}.')
 
-    return cigar_list
+    return {
+        'counts': counts,
+        'ops': bytes(ops),
+        'tr_ends': tr_ends,
+        'gen_shifts': gen_shifts,
+        'transcript_len': tr_len
+    }
 
 
-def get_genome_pos(transcript_coord, cigar_str, start_pos):
+def get_genome_pos(transcript_coord, cigar_str, start_pos, cigar_index=None):
     '''
     Calculates the genomic position of a transcript coordinate.
 
@@ -147,45 +381,224 @@ def get_genome_pos(transcript_coord, cigar_str, start_pos):
         transcript_coord: the query coordinate of the transcript/cigar_str
         cigar_str: the properly formated cigar string of the transcript
         start_pos: the genomic start position of the transcript
+        cigar_index: optional pre-computed index of cigar_str (from
+            index_cigar), so repeated queries don't re-parse the CIGAR
     Returns:
         genome_pos: the genomic position of the transcript coordinate, or NA if
             the transcript coordinate is in an insertion of the genome
     Raises:
-        ValueError: if transcript coord is outside of the length of the cigar
+        ValueError: if transcript coord is negative or outside of the length
+            of the cigar
     '''
 
-    cigar_list = cigar_str_to_list(cigar_str)
-    genome_pos = start_pos - 1
-    transcript_idx = - 1
+    if cigar_index is None:
+        cigar_index = index_cigar(cigar_str)
 
     # Check if query coordinate is within transcript
-    transcript_len = len(cigar_list) - cigar_list.count('D')
-    if transcript_coord >= transcript_len:
+    if not 0 <= transcript_coord < cigar_index['transcript_len']:
         raise ValueError(
             f'Query coord {transcript_coord} is outside of the query.')
 
-    for pos in cigar_list:
-        if transcript_idx < transcript_coord:
-            if pos == 'M':
-                # match, both pointers move forward
-                transcript_idx += 1
-                genome_pos += 1
-            elif pos == 'D':
-                # tr deletion, only genome_pos pointer moves forward
-                genome_pos += 1
-            elif pos == 'I':
-                # tr insertion, only tr_coord pointer moves forward
-                transcript_idx += 1
-                # if the transcript coordinate is in an insertion, return NA
-                if transcript_idx == transcript_coord:
-                    return 'NA'
-        else:
-            break
+    tr_ends = cigar_index['tr_ends']
+    if transcript_coord < tr_ends[0]:
+        # Queries often cluster at the 5' end; the first run can't be a
+        # deletion here (it would end at 0), so it's a match with no shift
+        # or an insertion
+        if cigar_index['ops'][0] == ord('I'):
+            return 'NA'
+        return start_pos + transcript_coord
+
+    # First run that ends past the query coordinate; deletions don't extend
+    # the transcript so this is always an M or I run
+    run = bisect_right(tr_ends, transcript_coord)
+    if cigar_index['ops'][run] == ord('I'):
+        # if the transcript coordinate is in an insertion, return NA
+        return 'NA'
+
+    # match, shifted onto the genome by the run's shift
+    return start_pos + cigar_index['gen_shifts'][run] + transcript_coord
+
+
+def get_genome_positions(transcript_coords, cigar_str, start_pos,
+                         cigar_index=None):
+    '''
+    Calculates the genomic positions of a batch of transcript coordinates
+    on the same transcript, looking up the cigar index only once.
+
+    Args:
+        transcript_coords: the query coordinates of the transcript/cigar_str
+        cigar_str: the properly formated cigar string of the transcript
+        start_pos: the genomic start position of the transcript
+        cigar_index: optional pre-computed index of cigar_str (from
+            index_cigar), so repeated queries don't re-parse the CIGAR
+    Returns:
+        A list of the genomic position of every transcript coordinate, or NA
+            where the transcript coordinate is in an insertion of the genome
+    Raises:
+        ValueError: if a transcript coord is negative or outside of the length
+            of the cigar
+    '''
+
+    if cigar_index is None:
+        cigar_index = index_cigar(cigar_str)
+    ops = cigar_index['ops']
+    tr_ends = cigar_index['tr_ends']
+    gen_shifts = cigar_index['gen_shifts']
+    insertion = ord('I')
+
+    # Check if query coordinates are within transcript
+    min_coord = min(transcript_coords, default=0)
+    if min_coord < 0:
+        raise ValueError(
+            f'Query coord {min_coord} is outside of the query.')
+    max_coord = max(transcript_coords, default=-1)
+    if max_coord >= cigar_index['transcript_len']:
+        raise ValueError(
+            f'Query coord {max_coord} is outside of the query.')
+
+    if (len(transcript_coords) >= len(ops) and all(map(
+            le, transcript_coords, islice(transcript_coords, 1, None)))):
+        # Coordinates are already in order and outnumber the runs, so one
+        # forward sweep over the runs is cheaper than a bisect per coordinate
+        genome_positions = list()
+        run = 0
+        for transcript_coord in transcript_coords:
+            while tr_ends[run] <= transcript_coord:
+                run += 1
+            if ops[run] == insertion:
+                genome_positions.append('NA')
+            else:
+                genome_positions.append(
+                    start_pos + gen_shifts[run] + transcript_coord)
+        return genome_positions
+
+    # First run that ends past each query coordinate; deletions don't extend
+    # the transcript so this is always an M or I run. map drives the bisects
+    # from C rather than a Python loop.
+    runs = map(bisect_right, repeat(tr_ends), transcript_coords)
+
+    # if the transcript coordinate is in an insertion, return NA; otherwise
+    # it's in a match, shifted onto the genome by the run's shift
+    return [
+        'NA' if ops[run] == insertion
+        else start_pos + gen_shifts[run] + transcript_coord
+        for run, transcript_coord in zip(runs, transcript_coords)]
+
+
+def read_queries(query_file, transcripts=None):
+    '''
+    Reads all of the queries in query_file.
+
+    Args:
+        query_file: path to the tsv of queries.
+            2 colunns: transcript ID to query, and transcript coordinate
+        transcripts: optional transcript dict (from get_transcript_dict)
+            whose ID objects are reused for the query IDs
+    Returns:
+        A tuple of the list of query transcript IDs (as bytes) and an array of
+        the query transcript coordinates, in query_file order. Queries on the
+        same transcript share one ID object, which is the transcripts dict's
+        own key when given.
+    Raises:
+        ValueError: if query_file has the wrong number of columns
+    '''
+
+    tr_ids = list()
+    tr_coords = array('q')
+    # Intern IDs (sys.intern only takes str), so repeated IDs aren't each
+    # kept as a separate bytes object. Seeding from the transcripts dict's
+    # keys means in-process lookups of query IDs in it match by identity
+    # rather than comparing bytes.
+    interned_ids = {tr_id: tr_id for tr_id in transcripts or ()}
+    with open(query_file, 'rb', buffering=IO_BUFFER_SIZE) as query_f:
+        for line in query_f:
+            fields = line.rstrip(b'\r\n').split(b'\t')
+            if len(fields) != 2:
+                raise ValueError(f'Incorrect format; {len(fields)} cols.')
+            tr_id = fields[0]
+            tr_ids.append(interned_ids.setdefault(tr_id, tr_id))
+            tr_coords.append(int(fields[1]))
+    return tr_ids, tr_coords
+
+
+def resolve_queries(transcripts, tr_ids, tr_coords):
+    '''
+    Calculates the genomic position of every query, grouping queries by
+    transcript so each transcript is looked up once and all of its queries
+    are resolved in a single batch.
+
+    Args:
+        transcripts: transcript dict (from get_transcript_dict)
+        tr_ids: the query transcript IDs
+        tr_coords: the query transcript coordinates
+    Returns:
+        A list of the genomic position of every query, in query order.
+    Raises:
+        ValueError: if a query coord is outside of its transcript
+    '''
+
+    # Query indices and coordinates are kept in packed arrays rather than
+    # lists of int objects
+    query_groups = dict()
+    for query_idx, tr_id in enumerate(tr_ids):
+        query_idxs = query_groups.get(tr_id)
+        if query_idxs is None:
+            query_idxs = query_groups[tr_id] = array('q')
+        query_idxs.append(query_idx)
+
+    gen_positions = [None] * len(tr_ids)
+    for tr_id, query_idxs in query_groups.items():
+        transcript = transcripts[tr_id]
+        group_coords = array('q', map(tr_coords.__getitem__, query_idxs))
+        group_positions = get_genome_positions(
+            transcript_coords=group_coords,
+            cigar_str=transcript['cigar'],
+            start_pos=transcript['gen_start'],
+            cigar_index=transcript)
+        for query_idx, gen_pos in zip(query_idxs, group_positions):
+            gen_positions[query_idx] = gen_pos
+    return gen_positions
+
+
+# Transcript dict shared by the queries resolved in a worker process
+_worker_transcripts = None
+
+
+def _init_worker(transcripts):
+    '''
+    Initializes a worker process with the read-only transcript dict, so it is
+    sent once per worker rather than once per chunk of queries.
+
+    Args:
+        transcripts: transcript dict (from get_transcript_dict)
+    Returns:
+        None; sets the worker's transcript dict.
+    Raises:
+        None
+    '''
+    global _worker_transcripts
+    _worker_transcripts = transcripts
+
 
-    return genome_pos
+def _resolve_query_chunk(tr_ids, tr_coords):
+    '''
+    Calculates the genomic position of every query in a chunk in a worker
+    process; see resolve_queries.
+
+    Args:
+        tr_ids: the chunk's query transcript IDs
+        tr_coords: the chunk's query transcript coordinates
+    Returns:
+        A list of the genomic position of every query in the chunk, in
+        query order.
+    Raises:
+        ValueError: if a query coord is outside of its transcript
+    '''
+    return resolve_queries(_worker_transcripts, tr_ids, tr_coords)
 
 
-def query_transcript(transcript_file, query_file, out):
+def query_transcript(transcript_file, query_file, out, workers=1,
+                     index_file=None):
     '''
     For every query in query_file, output a line in out where each line is
     4 cols of the query transcript, the query transcript position, the genomic
@@ -200,6 +613,10 @@ def query_transcript(transcript_file, query_file, out):
         out: path to output tsv.
             A line for every line in query_file, and 4 coluns: transcript ID,
             transcript coordinate, genomic chrom, and genomic position.
+        workers: number of processes to resolve queries with; queries are
+            split into chunks of QUERY_CHUNK_SIZE when more than 1.
+        index_file: optional path to save the parsed transcripts to and
+            reuse them from (see load_transcript_dict).
     Returns:
         None; writes an output file.
     Raises:
@@ -207,28 +624,45 @@ def query_transcript(transcript_file, query_file, out):
     '''
 
     # Build transcript dict
-    transcripts = get_transcript_dict(transcript_file=transcript_file)
-
-    # Iterate through queries
-    with open(out, 'w') as out_f:
-        out_writer = csv.writer(out_f, delimiter='\t')
-        with open(query_file, 'r') as query_f:
-            for line in query_f:
-                fields = [i.strip() for i in line.split('\t')]
-                if len(fields) != 2:
-                    raise ValueError(f'Incorrect format; {len(fields)} cols.')
-                tr_id, tr_coord = fields[0], int(fields[1])
-
-                # Get query transcript info from transcript dict
-                gen_chrom = transcripts[tr_id]['gen_chrom']
-                gen_start = transcripts[tr_id]['gen_start']
-                cigar_str = transcripts[tr_id]['cigar']
-                gen_pos = get_genome_pos(
-                    transcript_coord=tr_coord,
-                    cigar_str=cigar_str,
-                    start_pos=gen_start)
-
-                out_writer.writerow([tr_id, tr_coord, gen_chrom, gen_pos])
+    transcripts = load_transcript_dict(
+        transcript_file=transcript_file,
+        index_file=index_file)
+    tr_ids, tr_coords = read_queries(
+        query_file=query_file, transcripts=transcripts)
+
+    if workers > 1:
+        # Queries are independent, so resolve chunks of them in parallel;
+        # map yields the chunks' results back in submission order
+        chunk_starts = range(0, len(tr_ids), QUERY_CHUNK_SIZE)
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(transcripts,)) as executor:
+            chunk_positions = executor.map(
+                _resolve_query_chunk,
+                [tr_ids[i:i + QUERY_CHUNK_SIZE] for i in chunk_starts],
+                [tr_coords[i:i + QUERY_CHUNK_SIZE] for i in chunk_starts])
+            gen_positions = list(chain.from_iterable(chunk_positions))
+    else:
+        gen_positions = resolve_queries(transcripts, tr_ids, tr_coords)
+
+    # Write results in query order, in large buffered chunks and batching
+    # output rows to cut down on small write syscalls
+    out_rows = list()
+    with open(out, 'wb', buffering=IO_BUFFER_SIZE) as out_f:
+        for tr_id, tr_coord, gen_pos in zip(tr_ids, tr_coords, gen_positions):
+            # None of the fields need quoting, so format rows directly
+            gen_chrom = transcripts[tr_id]['gen_chrom']
+            if gen_pos == 'NA':
+                out_rows.append(
+                    b'%b\t%d\t%b\tNA\n' % (tr_id, tr_coord, gen_chrom))
+            else:
+                out_rows.append(b'%b\t%d\t%b\t%d\n' % (
+                    tr_id, tr_coord, gen_chrom, gen_pos))
+            if len(out_rows) >= OUT_BATCH_ROWS:
+                out_f.writelines(out_rows)
+                out_rows.clear()
+        out_f.writelines(out_rows)
     return
 
 
@@ -238,7 +672,8 @@ def parse_args():
     Args:
         None; takes user input.
     Returns:
-        Arguments inputted by user for transcript_fie, query_file, and out.
+        Arguments inputted by user for transcript_fie, query_file, out,
+        workers and index_file.
     Raises:
         None
     '''
@@ -246,12 +681,19 @@ def parse_args():
     parser.add_argument('-t', '--transcript-file', type=str, required=True)
     parser.add_argument('-q', '--query-file', type=str, required=True)
     parser.add_argument('-o', '--out', type=str, required=True)
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument(
+        '-i', '--index-file', type=str, default=None,
+        help='path to save parsed transcripts to and reuse them from. The '
+             'file is loaded with pickle, which can run arbitrary code, so '
+             'only use a path that you and this script alone write to.')
 
     args = parser.parse_args()
-    return args.transcript_file, args.query_file, args.out
+    return (args.transcript_file, args.query_file, args.out, args.workers,
+            args.index_file)
 
 
-def main(transcript_file, query_file, out):
+def main(transcript_file, query_file, out, workers=1, index_file=None):
     '''
     Main function, wraps query_transcript
 
@@ -264,13 +706,18 @@ def main(transcript_file, query_file, out):
         out: path to output tsv.
             A line for every line in query_file, and 4 coluns: transcript ID,
             transcript coordinate, genomic chrom, and genomic position.
+        workers: number of processes to resolve queries with.
+        index_file: optional path to save the parsed transcripts to and
+            reuse them from.
     Returns:
         None; writes an output file.
     '''
     query_transcript(
         transcript_file=transcript_file,
         query_file=query_file,
-        out=out)
+        out=out,
+        workers=workers,
+        index_file=index_file)
 
 if __name__ == '__main__':
     main(
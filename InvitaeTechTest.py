@@ -1,3 +1,7 @@
+from array import array
+import os
+import tempfile
+import threading
 import unittest
 import InvitaeTech as main
 
@@ -18,19 +22,60 @@ class TestQuery(unittest.TestCase):
         it as a dict
         '''
         expected_dict = {
-            'TR1': {
-                'gen_chrom': 'CHR1',
+            b'TR1': {
+                'gen_chrom': b'CHR1',
                 'gen_start': 3,
-                'cigar': '8M7D6M2I2M11D7M'},
-            'TR2': {
-                'gen_chrom': 'CHR2',
+                'cigar': b'8M7D6M2I2M11D7M',
+                'counts': array('q', [8, 7, 6, 2, 2, 11, 7]),
+                'ops': b'MDMIMDM',
+                'tr_ends': array('q', [8, 8, 14, 16, 18, 18, 25]),
+                'gen_shifts': array('q', [0, 7, 7, 5, 5, 16, 16]),
+                'transcript_len': 25},
+            b'TR2': {
+                'gen_chrom': b'CHR2',
                 'gen_start': 10,
-                'cigar': '20M'}}
+                'cigar': b'20M',
+                'counts': array('q', [20]),
+                'ops': b'M',
+                'tr_ends': array('q', [20]),
+                'gen_shifts': array('q', [0]),
+                'transcript_len': 20}}
 
         self.assertEqual(
             main.get_transcript_dict(transcript_file=TEST_INPUT1),
             expected_dict)
 
+    def test_get_transcript_dict_empty(self):
+        '''
+        Test an empty transcript file gives an empty dict
+        '''
+        with tempfile.NamedTemporaryFile(suffix='.tsv') as empty_f:
+            self.assertEqual(
+                main.get_transcript_dict(transcript_file=empty_f.name),
+                dict())
+
+    def test_get_transcript_dict_fifo(self):
+        '''
+        Test reading transcripts from a FIFO, which can't be mapped
+        and always reports a size of 0
+        '''
+        expected_dict = main.get_transcript_dict(transcript_file=TEST_INPUT1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fifo = os.path.join(tmp_dir, 'input1.fifo')
+            os.mkfifo(fifo)
+
+            def write_fifo():
+                with open(TEST_INPUT1, 'rb') as in_f, \
+                        open(fifo, 'wb') as fifo_f:
+                    fifo_f.write(in_f.read())
+
+            writer = threading.Thread(target=write_fifo)
+            writer.start()
+            self.addCleanup(writer.join)
+            self.assertEqual(
+                main.get_transcript_dict(transcript_file=fifo),
+                expected_dict)
+
     def test_get_trans_dict_invalid(self):
         '''
         Test that a transcript file with the incorrect number
@@ -40,6 +85,105 @@ class TestQuery(unittest.TestCase):
             ValueError,
             main.get_transcript_dict, TEST_INPUT1_INVALID)
 
+    def test_load_transcript_dict_index(self):
+        '''
+        Test the transcript dict is saved to an index file, reused
+        while it was built from the transcript file as it is now, and
+        rebuilt after
+        '''
+        expected_dict = main.get_transcript_dict(transcript_file=TEST_INPUT1)
+        source = main.get_file_identity(TEST_INPUT1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_file = os.path.join(tmp_dir, 'input1.idx')
+            self.assertEqual(
+                main.load_transcript_dict(
+                    transcript_file=TEST_INPUT1, index_file=index_file),
+                expected_dict)
+            self.assertTrue(os.path.exists(index_file))
+
+            # An index of the same file is loaded instead of re-reading it
+            stale_dict = {b'TR2': expected_dict[b'TR2']}
+            main.save_transcript_index(
+                transcripts=stale_dict, index_file=index_file, source=source)
+            self.assertEqual(
+                main.load_transcript_dict(
+                    transcript_file=TEST_INPUT1, index_file=index_file),
+                stale_dict)
+
+            # An index of the file at a different mtime is rebuilt
+            path, size, mtime_ns = source
+            main.save_transcript_index(
+                transcripts=stale_dict, index_file=index_file,
+                source=(path, size, mtime_ns - 1))
+            self.assertEqual(
+                main.load_transcript_dict(
+                    transcript_file=TEST_INPUT1, index_file=index_file),
+                expected_dict)
+
+    def test_load_transcript_dict_index_invalid(self):
+        '''
+        Test an index file that isn't a valid index is rebuilt
+        rather than failing the run
+        '''
+        expected_dict = main.get_transcript_dict(transcript_file=TEST_INPUT1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_file = os.path.join(tmp_dir, 'bad.idx')
+            for bad_index in (b'', b'garbage', main.pickle.dumps([1, 2])):
+                with open(index_file, 'wb') as index_f:
+                    index_f.write(bad_index)
+                self.assertEqual(
+                    main.load_transcript_dict(
+                        transcript_file=TEST_INPUT1, index_file=index_file),
+                    expected_dict)
+                # and the rebuilt index is reused
+                self.assertEqual(
+                    main.read_transcript_index(
+                        index_file=index_file,
+                        source=main.get_file_identity(TEST_INPUT1)),
+                    expected_dict)
+
+    def test_load_transcript_dict_index_other_file(self):
+        '''
+        Test one index file pointed at two different transcript files
+        is rebuilt for each, even when the second is older than the index
+        '''
+        expected_dict = main.get_transcript_dict(transcript_file=TEST_INPUT1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_file = os.path.join(tmp_dir, 'shared.idx')
+            other_file = os.path.join(tmp_dir, 'other.tsv')
+            with open(other_file, 'w') as other_f:
+                other_f.write('TR1\tCHRX\t100\t5M\n')
+            # older than the index built from TEST_INPUT1 below
+            os.utime(other_file, (0, 0))
+
+            self.assertEqual(
+                main.load_transcript_dict(
+                    transcript_file=TEST_INPUT1, index_file=index_file),
+                expected_dict)
+            self.assertEqual(
+                main.load_transcript_dict(
+                    transcript_file=other_file, index_file=index_file),
+                main.get_transcript_dict(transcript_file=other_file))
+            self.assertEqual(
+                main.load_transcript_dict(
+                    transcript_file=TEST_INPUT1, index_file=index_file),
+                expected_dict)
+
+    def test_transcript_index_round_trip(self):
+        '''
+        Test saving the transcript dict to an index and reading it back
+        '''
+        expected_dict = main.get_transcript_dict(transcript_file=TEST_INPUT1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_file = os.path.join(tmp_dir, 'input1.idx')
+            main.save_transcript_index(
+                transcripts=expected_dict, index_file=index_file)
+            self.assertEqual(
+                main.read_transcript_index(index_file=index_file),
+                expected_dict)
+            # the temporary file it was written through is gone
+            self.assertEqual(os.listdir(tmp_dir), ['input1.idx'])
+
     def test_is_cigar_valid_ok(self):
         '''
         Test is_cigar_valid with valid CIGARs
@@ -63,25 +207,67 @@ class TestQuery(unittest.TestCase):
         self.assertEqual(main.is_cigar_valid(cigar_str='2M3'), False)
         self.assertEqual(main.is_cigar_valid(cigar_str='M3'), False)
         self.assertEqual(main.is_cigar_valid(cigar_str=''), False)
+        self.assertEqual(main.is_cigar_valid(cigar_str='2M|3I'), False)
+        self.assertEqual(main.is_cigar_valid(cigar_str='2MM'), False)
 
-    def test_cigar_str_to_list(self):
+    def test_index_cigar_runs(self):
         '''
-        Test ciar_str_to_list; converting a cigar string
-        to an expanded list of qualifiers (M, D, I)
+        Test index_cigar; converting a cigar string
+        to packed run-length counts and qualifiers
         '''
-        self.assertListEqual(
-            main.cigar_str_to_list(cigar_str='1M'),
-            ['M'])
-        self.assertListEqual(
-            main.cigar_str_to_list(cigar_str='2D1M'),
-            ['D', 'D', 'M'])
-        self.assertListEqual(
-            main.cigar_str_to_list(cigar_str='8M7D6M2I2M11D7M'),
-            ['M', 'M', 'M', 'M', 'M', 'M', 'M', 'M', 'D',
-             'D', 'D', 'D', 'D', 'D', 'D', 'M', 'M', 'M',
-             'M', 'M', 'M', 'I', 'I', 'M', 'M', 'D', 'D',
-             'D', 'D', 'D', 'D', 'D', 'D', 'D', 'D', 'D',
-             'M', 'M', 'M', 'M', 'M', 'M', 'M'])
+        for cigar_str, counts, ops in (
+                ('1M', [1], b'M'),
+                ('2D1M', [2, 1], b'DM'),
+                (b'2D1M', [2, 1], b'DM'),
+                ('8M7D6M12I2M11D7M', [8, 7, 6, 12, 2, 11, 7], b'MDMIMDM')):
+            cigar_index = main.index_cigar(cigar_str=cigar_str)
+            self.assertEqual(cigar_index['counts'], array('q', counts))
+            self.assertEqual(cigar_index['ops'], ops)
+
+    def test_index_cigar_invalid(self):
+        '''
+        Test index_cigar raises an error on invalid CIGARs
+        '''
+        for cigar_str in ('2M3N7D', '2M3', 'M3', ''):
+            self.assertRaises(ValueError, main.index_cigar, cigar_str)
+        # Non UTF-8 input is reported as an invalid cigar, not a decode error
+        with self.assertRaisesRegex(ValueError, 'Invalid cigar'):
+            main.index_cigar(b'3M\xff')
+        with self.assertRaisesRegex(ValueError, 'Invalid cigar'):
+            main.index_cigar(b'3M\xff4')
+
+    def test_index_cigar(self):
+        '''
+        Test index_cigar; cumulative transcript lengths and
+        genome shifts at the end of every run
+        '''
+        self.assertEqual(
+            main.index_cigar(cigar_str='3M1D2I'),
+            {'counts': array('q', [3, 1, 2]),
+             'ops': b'MDI',
+             'tr_ends': array('q', [3, 3, 5]),
+             'gen_shifts': array('q', [0, 1, -1]),
+             'transcript_len': 5})
+
+    def test_get_genome_pos_cigar_index(self):
+        '''
+        Test get_genome_pos with a pre-computed cigar index
+        '''
+        cigar_index = main.index_cigar(cigar_str='8M7D6M2I2M11D7M')
+        self.assertEqual(
+            main.get_genome_pos(
+                transcript_coord=13,
+                cigar_str='8M7D6M2I2M11D7M',
+                start_pos=3,
+                cigar_index=cigar_index),
+            23)
+        self.assertEqual(
+            main.get_genome_pos(
+                transcript_coord=15,
+                cigar_str='8M7D6M2I2M11D7M',
+                start_pos=3,
+                cigar_index=cigar_index),
+            'NA')
 
     def test_get_genome_pos_m_offset(self):
         '''
@@ -184,6 +370,13 @@ class TestQuery(unittest.TestCase):
                 cigar_str='8M7D6M2I2M11D7M',
                 start_pos=3),
             18)
+        # Check the first position after a leading del
+        self.assertEqual(
+            main.get_genome_pos(
+                transcript_coord=0,
+                cigar_str='2D3M',
+                start_pos=5),
+            7)
 
     def test_get_genome_pos_combo(self):
         '''
@@ -204,6 +397,39 @@ class TestQuery(unittest.TestCase):
                 start_pos=2),
             'NA')
 
+    def test_get_genome_positions(self):
+        '''
+        Test get_genome_positions on a batch of coordinates in the same
+        transcript, in and out of insertions and deletions
+        '''
+        self.assertListEqual(
+            main.get_genome_positions(
+                transcript_coords=[4, 13, 0, 15, 8, 19],
+                cigar_str='8M7D6M2I2M11D7M',
+                start_pos=3),
+            [7, 23, 3, 'NA', 18, 38])
+        self.assertRaises(
+            ValueError,
+            main.get_genome_positions, [0, 8], '3M2D1I1M1I2M', 2)
+
+    def test_get_genome_positions_sorted(self):
+        '''
+        Test get_genome_positions on sorted coordinates that outnumber
+        the CIGAR runs, which are resolved in a single sweep
+        '''
+        self.assertListEqual(
+            main.get_genome_positions(
+                transcript_coords=[0, 1, 2, 3, 4, 5, 6, 7],
+                cigar_str='3M2D1I1M1I2M',
+                start_pos=2),
+            [2, 3, 4, 'NA', 7, 'NA', 8, 9])
+        self.assertListEqual(
+            main.get_genome_positions(
+                transcript_coords=[0, 0, 3, 3, 5, 6, 6, 7],
+                cigar_str='1I2M2D1I1M1I2M',
+                start_pos=2),
+            ['NA', 'NA', 'NA', 'NA', 'NA', 7, 7, 8])
+
     def test_get_genome_pos_invalid(self):
         '''
         Test get_genome_pos for a query position that's outside
@@ -213,6 +439,43 @@ class TestQuery(unittest.TestCase):
             ValueError,
             main.get_genome_pos, 8, '3M2D1I1M1I2M', 2)
 
+    def test_read_queries(self):
+        '''
+        Test reading input2 (query_file) in file order, with
+        repeated transcript IDs interned
+        '''
+        tr_ids, tr_coords = main.read_queries(query_file=TEST_INPUT2)
+        self.assertEqual(
+            (tr_ids, tr_coords),
+            ([b'TR1', b'TR2', b'TR1', b'TR2'], array('q', [4, 0, 13, 10])))
+        # Repeated IDs are interned to the same object
+        self.assertIs(tr_ids[0], tr_ids[2])
+        self.assertIs(tr_ids[1], tr_ids[3])
+
+        # IDs are interned to the transcript dict's keys when given
+        transcripts = main.get_transcript_dict(transcript_file=TEST_INPUT1)
+        tr_keys = {tr_id: tr_id for tr_id in transcripts}
+        tr_ids, _ = main.read_queries(
+            query_file=TEST_INPUT2, transcripts=transcripts)
+        self.assertIs(tr_ids[0], tr_keys[b'TR1'])
+        self.assertIs(tr_ids[1], tr_keys[b'TR2'])
+
+    def test_get_genome_pos_negative(self):
+        '''
+        Test single and batch lookups both reject a negative query
+        position, including before a leading deletion or insertion
+        '''
+        for cigar_str in ('2D3M', '2I3M', '3M'):
+            self.assertRaises(
+                ValueError,
+                main.get_genome_pos, -1, cigar_str, 5)
+            self.assertRaises(
+                ValueError,
+                main.get_genome_positions, [-1], cigar_str, 5)
+            self.assertRaises(
+                ValueError,
+                main.get_genome_positions, [0, 1, 2, -1], cigar_str, 5)
+
     def test_query_transcript(self):
         '''
         Test query_tramscript method from input files to output files
@@ -235,5 +498,31 @@ class TestQuery(unittest.TestCase):
                 out_list.append([i.strip() for i in line.split('\t')])
         self.assertEqual(out_list, expected_out)
 
+    def test_query_transcript_workers(self):
+        '''
+        Test query_transcript resolving queries in worker processes
+        gives the same output, with chunks of queries coming back in
+        query order
+        '''
+        # One query per chunk, so every query is resolved in its own chunk
+        chunk_size = main.QUERY_CHUNK_SIZE
+        main.QUERY_CHUNK_SIZE = 1
+        self.addCleanup(setattr, main, 'QUERY_CHUNK_SIZE', chunk_size)
+
+        main.query_transcript(
+            transcript_file=TEST_INPUT1,
+            query_file=TEST_INPUT2,
+            out=TEST_OUT)
+        with open(TEST_OUT, 'r') as result_f:
+            expected_out = result_f.read()
+
+        main.query_transcript(
+            transcript_file=TEST_INPUT1,
+            query_file=TEST_INPUT2,
+            out=TEST_OUT,
+            workers=2)
+        with open(TEST_OUT, 'r') as result_f:
+            self.assertEqual(result_f.read(), expected_out)
+
 if __name__ == '__main__':
     unittest.main()